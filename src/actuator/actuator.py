@@ -4,6 +4,8 @@ import json
 import socket
 import sys
 import threading
+import time
+import uuid
 try:
     import RPi.GPIO as gpio
     gpio.setmode(gpio.BCM)
@@ -16,6 +18,68 @@ def toint(str):
     except ValueError:
         return None
 
+class latencyRecorder(object):
+    """
+    Records per-hop latency of internal messages to a JSON-lines trace log.
+    This matches the recorder in cloudtalker, so the two processes' logs can be merged
+    (see tools/trace_report.py). A trace is carried in the "trace" key of internal
+    JSON messages: {"id": <trace id>, "hop": <previous hop>, "t": <time.monotonic()>}
+    Recording is disabled, and no traces are created, until open() is called.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.lock = threading.Lock()
+        self.logf = None
+
+    def open(self, logpath):
+        """
+        Start appending trace records to the given log file.
+        """
+        if logpath:
+            self.logf = open(logpath, "a")
+
+    def valid(self, trace):
+        """
+        Check a trace (which may have come from another process) is well-formed.
+        """
+        return (isinstance(trace, dict) and isinstance(trace.get("t"), (int, float))
+            and not isinstance(trace["t"], bool))
+
+    def start(self, hop):
+        """
+        Begin a new trace at the named hop.
+        Returns the trace dict, or None if recording is disabled.
+        """
+        if self.logf is None:
+            return None
+        return {"id": uuid.uuid4().hex, "hop": hop, "t": time.monotonic()}
+
+    def hop(self, trace, hop):
+        """
+        Record arrival of a trace at the named hop. Returns the (updated) trace so it
+        can be forwarded; traces that are None or malformed are passed through untouched.
+        """
+        if self.logf is None or not self.valid(trace):
+            return trace
+        now = time.monotonic()
+        record = {
+            "id": trace.get("id"),
+            "proc": self.proc,
+            "from": trace.get("hop"),
+            "to": hop,
+            "t": now,
+            "dt": now - trace["t"],
+        }
+        trace["hop"] = hop
+        trace["t"] = now
+        with self.lock:
+            self.logf.write(json.dumps(record) + "\n")
+            self.logf.flush()
+        return trace
+
+#module-wide recorder, enabled with --trace_log
+latency = latencyRecorder("actuator")
+
 class actuator(object):
     """
     This class acts as a simple actuator. It can be subclassed if required to give
@@ -59,12 +123,16 @@ class actuator(object):
         """
         print("rising edge detected on GPIO", channel)
         if self.addrtuple is not None:
+            trace = latency.start("event")
             msg = {
                 'event': 'alarm',
                 'gpio': self.inputpin,
             }
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((self.addrtuple[0], self.addrtuple[1]))
+            trace = latency.hop(trace, "connect")
+            if trace is not None:
+                msg['trace'] = trace
             s.send(json.dumps(msg).encode('utf-8'))
             s.close()
 
@@ -140,11 +208,14 @@ class cmd_listener(object):
             data, addr = self.insock.recvfrom(1024)
             js = json.loads(data.decode('utf-8'))
             print("received JSON:", js)
+            trace = latency.hop(js.get("trace"), "cmd_listener")
             if self.handler and "command" in js:
                 if js["command"] == "arm":
                     self.handler.activate()
+                    latency.hop(trace, "activate")
                 elif js["command"] == "disarm":
                     self.handler.deactivate()
+                    latency.hop(trace, "deactivate")
 
 if __name__ == "__main__":
     def get_args():
@@ -160,9 +231,12 @@ if __name__ == "__main__":
             help="Output actuator GPIO (drive this GPIO when armed)")
         parser.add_argument('--event_gpio', default=None,
             help="Input event GPIO (interrupt on this GPIO going high)")
+        parser.add_argument('--trace_log', default=None,
+            help="Append per-hop latency trace records to this file (tracing is off if unset)")
         return parser.parse_args()
 
     args = get_args()
+    latency.open(args.trace_log)
     a = actuator(outputpin=args.actuator_gpio, inputpin=args.event_gpio, outaddr=args.outaddr)
     with cmd_listener(inport=args.inport, handler=a) as listener:
         listener.run()
@@ -10,6 +10,11 @@ import time
 import datetime
 import threading
 import queue
+import uuid
+import base64
+import codecs
+import subprocess
+import concurrent.futures
 
 def readFileChunks(f, chunk_size=1024):
     """
@@ -28,7 +33,7 @@ def toInt(str):
     try:
         port = int(str)
         return port
-    except ValueError:
+    except (ValueError, TypeError):
         return None
 
 def split_inet_addr(addr):
@@ -45,31 +50,408 @@ def split_inet_addr(addr):
         return None
     return (ip, port)
 
+def extract_preview(fpath, width=320, timeout=10):
+    """
+    Pull the first keyframe out of a video file as a scaled-down JPEG, using ffmpeg.
+    Returns the JPEG bytes, or None if extraction failed
+    """
+    cmd = ["ffmpeg", "-loglevel", "error", "-skip_frame", "nokey", "-i", fpath,
+        "-frames:v", "1", "-vf", "scale=%d:-2" % width, "-f", "image2", "-c:v", "mjpeg", "pipe:1"]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("cloudtalker: preview extraction failed for", fpath, e)
+        return None
+    if proc.returncode != 0 or not proc.stdout:
+        print("cloudtalker: preview extraction failed for", fpath,
+            proc.stderr.decode("utf-8", "replace"))
+        return None
+    return proc.stdout
+
+class latencyRecorder(object):
+    """
+    Records per-hop latency of internal (non-server) messages to a JSON-lines trace log.
+    A trace is a small dict carried in the "trace" key of internal JSON messages:
+        {"id": <trace id>, "hop": <name of previous hop>, "t": <time.monotonic() at that hop>}
+    Each call to hop() logs the time elapsed since the previous hop and moves the trace on.
+    time.monotonic() is system-wide on Linux, so traces may cross process boundaries on the
+    same host. Recording is disabled, and no traces are created, until open() is called.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.lock = threading.Lock()
+        self.logf = None
+
+    def open(self, logpath):
+        """
+        Start appending trace records to the given log file.
+        """
+        if logpath:
+            self.logf = open(logpath, "a")
+
+    def valid(self, trace):
+        """
+        Check a trace (which may have come from another process) is well-formed.
+        """
+        return (isinstance(trace, dict) and isinstance(trace.get("t"), (int, float))
+            and not isinstance(trace["t"], bool))
+
+    def start(self, hop):
+        """
+        Begin a new trace at the named hop.
+        Returns the trace dict, or None if recording is disabled.
+        """
+        if self.logf is None:
+            return None
+        return {"id": uuid.uuid4().hex, "hop": hop, "t": time.monotonic()}
+
+    def branch(self, trace):
+        """
+        Return a copy of a trace with a new trace id, for when one message fans out
+        into several (e.g. one server message triggering several commands). Each
+        branch then records its own hops from the shared starting point.
+        """
+        if not self.valid(trace):
+            return trace
+        return {"id": uuid.uuid4().hex, "hop": trace.get("hop"), "t": trace["t"]}
+
+    def hop(self, trace, hop):
+        """
+        Record arrival of a trace at the named hop. Returns the (updated) trace so it
+        can be forwarded; traces that are None or malformed are passed through untouched.
+        """
+        if self.logf is None or not self.valid(trace):
+            return trace
+        now = time.monotonic()
+        record = {
+            "id": trace.get("id"),
+            "proc": self.proc,
+            "from": trace.get("hop"),
+            "to": hop,
+            "t": now,
+            "dt": now - trace["t"],
+        }
+        trace["hop"] = hop
+        trace["t"] = now
+        with self.lock:
+            self.logf.write(json.dumps(record) + "\n")
+            self.logf.flush()
+        return trace
+
+#module-wide recorder, enabled with --trace_log
+latency = latencyRecorder("cloudtalker")
+
+class uploadConnection(threading.Thread):
+    """
+    An extra, upload-only WebSocket connection to the server, authenticated with the
+    same client certificate as the control connection. Segment jobs queued with
+    add_segment() are sent over this connection in order, in parallel with any
+    other upload connections. The server reassembles a capture's segments using the
+    trigger_timestamp and seg_no in each capture_segment header.
+    The connection is opened as soon as the thread starts, and pinged while idle so
+    a dropped connection is noticed (and replaced) before the next segment needs it.
+    """
+    def __init__(self, upload, url, sslopt=None, ping_interval=55):
+        super(uploadConnection, self).__init__()
+        self.daemon = True
+        self.upload = upload
+        self.url = url
+        self.sslopt = sslopt
+        self.ping_interval = ping_interval
+        self.ws = None
+        self.jobs = queue.Queue()
+
+    def connect(self):
+        if self.ws:
+            self.ws.close()
+            self.ws = None
+        self.ws = websocket.create_connection(self.url, sslopt=self.sslopt)
+        #the server's messages (and pings) must be read, or they pile up unanswered
+        reader = threading.Thread(target=self.read, args=(self.ws,))
+        reader.daemon = True
+        reader.start()
+
+    def read(self, ws):
+        """
+        Read and discard messages from the server. websocket-client answers any
+        pings while reading. Stops when the connection is closed.
+        """
+        try:
+            while True:
+                ws.recv()
+        except Exception:
+            pass
+
+    def keepalive(self):
+        """
+        Ping the idle connection, reconnecting if that fails.
+        """
+        try:
+            if self.ws is None:
+                self.connect()
+            else:
+                self.ws.ping()
+        except Exception as e:
+            print("upload connection error:", e)
+            self.ws = None
+
+    def send(self, data, isText=True):
+        self.ws.send(data, opcode=websocket.ABNF.OPCODE_TEXT if isText else websocket.ABNF.OPCODE_BINARY)
+
+    def add_segment(self, job):
+        """
+        Queue a segment job (see upload.dispatch_segment) to be sent on this connection.
+        This function may be called from any thread
+        """
+        self.jobs.put(job)
+
+    def close(self):
+        """
+        Stop this connection once its queued jobs have been sent.
+        """
+        self.jobs.put(None)
+
+    def run(self):
+        self.keepalive()
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.ping_interval)
+            except queue.Empty:
+                self.keepalive()
+                continue
+            if job is None:
+                self.jobs.task_done()
+                break
+            #reconnect and resend the whole segment once if the connection fails,
+            #then fall back to the control connection. Each resent header carries an
+            #attempt number, so the server knows to discard the failed attempt's data.
+            for attempt in range(3):
+                try:
+                    if attempt == 2:
+                        print("upload connection failed twice, sending segment %d on"
+                            " the control connection" % job["segno"])
+                        self.upload.send_segment(job, sender=self.upload.ctalker,
+                            attempt=attempt)
+                        break
+                    if self.ws is None or attempt > 0:
+                        self.connect()
+                    self.upload.send_segment(job, sender=self, attempt=attempt)
+                    break
+                except Exception as e:
+                    print("upload connection error:", e)
+            else:
+                print("cloudtalker: ERROR: segment %d of capture %d was NOT uploaded,"
+                    " the capture on the server is incomplete" % (job["segno"], job["ts"]))
+            self.jobs.task_done()
+        if self.ws:
+            self.ws.close()
+            self.ws = None
+
 class upload(threading.Thread):
-    def __init__(self, ctalker):
+    def __init__(self, ctalker, preview_workers=0,
+            stream_poll=0.05, stream_timeout=30, connections=0):
+        """
+        ctalker: cloudtalker object used to send messages to the server
+        preview_workers: if non-zero, extract a keyframe preview from segment 0 of each
+        capture in a pool of this many worker threads, and send it to the server
+        ahead of the bulk video data
+        stream_poll: how often (seconds) to poll a growing segment file for new data
+        stream_timeout: give up on a growing segment file if it has not grown, and has
+        not been closed, for this long (seconds)
+        connections: if non-zero, open this many extra upload connections (see
+        open_connections) and stripe each capture's segments across them
+        """
         super(upload, self).__init__()
         self.ctalker = ctalker
         self.shouldStop = threading.Event()
         self.inq = queue.Queue()
+        #events are sent by their own thread, so they never wait behind a segment upload
+        self.eventq = queue.Queue()
+        self.event_thread = threading.Thread(target=self.run_events)
         self.current_captype = None
         self.current_capts = None
         self.current_segno = None
+        self.preview_pool = None
+        self.pending_preview = None
+        #guards pending_preview, which upload connections' preview callbacks also use
+        self.preview_lock = threading.RLock()
+        self.stream_poll = stream_poll
+        self.stream_timeout = stream_timeout
+        #segment files still being written, as <path>:<final size, or None while open>
+        self.streaming = {}
+        self.streaming_cond = threading.Condition()
+        self.num_connections = connections
+        self.connections = []
+        self.next_connection = 0
+        if preview_workers:
+            self.preview_pool = concurrent.futures.ThreadPoolExecutor(max_workers=preview_workers)
+
+    def open_connections(self, url, sslopt=None):
+        """
+        Start the extra upload connections requested at init time.
+        Must be called before this thread is started.
+        """
+        for i in range(self.num_connections):
+            conn = uploadConnection(self, url, sslopt)
+            conn.start()
+            self.connections.append(conn)
 
     def init_capture(self):
+        #urgent, so it can't be held back behind segment data sent on upload connections
         self.ctalker.send("{\"type\":\"capture_start\",\"trigger_timestamp\":%d,"
-            "\"trigger\":\"%s\"}" % (self.current_capts, self.current_captype))
+            "\"trigger\":\"%s\"}" % (self.current_capts, self.current_captype),
+            urgent=True)
+        self.send_preview()
+        if self.connections and self.pending_preview is not None:
+            #segment data isn't sent on this thread (which may be blocked in
+            #end_capture), so send the preview from the worker as soon as it is ready
+            self.pending_preview.add_done_callback(self.send_preview)
 
-    def upload_one_file(self, fpath):
-        self.ctalker.send("{\"type\":\"capture_segment\",\"trigger_timestamp\":%d,"
-            "\"trigger\":\"%s\",\"seg_no\":%d}" %
-            (self.current_capts, self.current_captype, self.current_segno))
+    def send_preview(self, future=None):
+        """
+        Send the current capture's preview image, if its extraction has finished.
+        This is a self-contained text message, so it can safely be sent between the
+        binary chunks of a segment upload.
+        future: the preview that has just finished, when called as a done callback.
+        It is only sent if it is still the current capture's preview.
+        """
+        with self.preview_lock:
+            if self.pending_preview is None or not self.pending_preview.done():
+                return
+            if future is not None and future is not self.pending_preview:
+                return
+            future = self.pending_preview
+            self.pending_preview = None
+            if future.cancelled():
+                return
+            image = future.result()
+            if image is None:
+                return
+            toserver = {
+                "type": "capture_preview",
+                "trigger_timestamp": self.current_capts,
+                "trigger": self.current_captype,
+                "format": "jpeg",
+                "data": base64.b64encode(image).decode("ascii"),
+            }
+            self.ctalker.send(json.dumps(toserver))
+
+    def segment_header(self, job=None, attempt=0):
+        """
+        Return the capture_segment header for a dispatched segment job, or for the
+        current segment if no job is given.
+        attempt: if non-zero, this is a resend of a segment that failed part-way
+        """
+        if job is None:
+            values = (self.current_capts, self.current_captype, self.current_segno)
+        else:
+            values = (job["ts"], job["trigger"], job["segno"])
+        header = ("{\"type\":\"capture_segment\",\"trigger_timestamp\":%d,"
+            "\"trigger\":\"%s\",\"seg_no\":%d" % values)
+        if attempt:
+            header += ",\"attempt\":%d" % attempt
+        return header + "}"
+
+    def dispatch_segment(self, fdata):
+        """
+        Hand the current segment to the next upload connection (round-robin).
+        """
+        job = {
+            "path": fdata["path"],
+            "streaming": fdata.get("streaming", False),
+            "ts": self.current_capts,
+            "trigger": self.current_captype,
+            "segno": self.current_segno,
+        }
+        conn = self.connections[self.next_connection]
+        self.next_connection = (self.next_connection + 1) % len(self.connections)
+        conn.add_segment(job)
+
+    def send_segment(self, job, sender, attempt=0):
+        """
+        Send a dispatched segment job over an upload connection.
+        """
+        header = self.segment_header(job, attempt)
+        if job["streaming"]:
+            self.stream_one_file(job["path"], header=header, sender=sender)
+        else:
+            self.upload_one_file(job["path"], header=header, sender=sender)
+
+    def upload_one_file(self, fpath, header=None, sender=None):
+        """
+        Upload a complete segment file.
+        header: capture_segment header to send (defaults to the current segment's)
+        sender: connection to send over (defaults to the control connection)
+        """
+        if sender is None:
+            sender = self.ctalker
+        sender.send(header or self.segment_header())
         with open(fpath, "rb") as f:
             print("uploading file now...")
             for data in readFileChunks(f, chunk_size=1300):
-                self.ctalker.send(data, isText=False)
+                if sender is self.ctalker:
+                    #the preview jumps the queue as soon as it is ready
+                    self.send_preview()
+                sender.send(data, isText=False)
             print("file upload completed")
 
+    def stream_one_file(self, fpath, header=None, sender=None):
+        """
+        Upload a segment file that is still being written, sending data as it
+        appears. Finishes once the producer has closed the segment and every byte
+        up to its final size has been sent.
+        header, sender: as for upload_one_file()
+        """
+        if sender is None:
+            sender = self.ctalker
+        sender.send(header or self.segment_header())
+        fd = os.open(fpath, os.O_RDONLY)
+        try:
+            print("streaming file now...")
+            offset = 0
+            last_growth = time.monotonic()
+            while True:
+                with self.streaming_cond:
+                    final_size = self.streaming.get(fpath)
+                if final_size is not None and offset >= final_size:
+                    break
+                #never send past the size declared in the "closed" message
+                length = 1300 if final_size is None else min(1300, final_size - offset)
+                data = os.pread(fd, length, offset)
+                if data:
+                    if sender is self.ctalker:
+                        self.send_preview()
+                    sender.send(data, isText=False)
+                    offset += len(data)
+                    last_growth = time.monotonic()
+                    continue
+                if time.monotonic() - last_growth > self.stream_timeout:
+                    print("cloudtalker: segment stopped growing, giving up on", fpath)
+                    break
+                #no new data yet (even if closed, the writer may not have flushed), so
+                #wait for the writer, or wake early if the segment is closed meanwhile
+                with self.streaming_cond:
+                    if self.streaming.get(fpath) == final_size:
+                        self.streaming_cond.wait(timeout=self.stream_poll)
+        finally:
+            os.close(fd)
+        print("file stream completed")
+        with self.streaming_cond:
+            self.streaming.pop(fpath, None)
+
     def end_capture(self):
+        #capture_end must follow every segment, so wait for the upload connections
+        for conn in self.connections:
+            conn.jobs.join()
+        #the video has all been sent, so a preview that still isn't ready is dropped
+        #rather than holding up the next capture
+        with self.preview_lock:
+            self.send_preview()
+            if self.pending_preview is not None:
+                print("cloudtalker: preview not ready by capture end, skipping")
+                self.pending_preview.cancel()
+                self.pending_preview = None
         self.ctalker.send("{\"type\":\"capture_end\",\"trigger_timestamp\":%d,"
             "\"trigger\":\"%s\"}" % (self.current_capts, self.current_captype))
         #reset variables for later usage
@@ -81,8 +463,40 @@ class upload(threading.Thread):
         """
         self.shouldStop.set()
         self.inq.join()
+        self.eventq.join()
+        self.event_thread.join()
+        if self.preview_pool:
+            self.preview_pool.shutdown(wait=False)
+        for conn in self.connections:
+            conn.close()
         super(upload, self).join()
 
+    def start(self):
+        """
+        Thread start. Also starts the event-sending thread.
+        """
+        self.event_thread.start()
+        super(upload, self).start()
+
+    def run_events(self):
+        """
+        Send queued events to the server, independently of segment uploads.
+        """
+        while not self.shouldStop.isSet():
+            try:
+                fdata = self.eventq.get(timeout=5)
+                trace = latency.hop(fdata.get("trace"), "upload")
+                if fdata["event"] == "alarm":
+                    toserver = {
+                        "type": "alarm",
+                        "trigger_timestamp": int(time.time()),
+                    }
+                    self.ctalker.send(json.dumps(toserver), urgent=True)
+                    latency.hop(trace, "ws_send")
+                self.eventq.task_done()
+            except queue.Empty:
+                pass #continue through loop and wait again if necessary
+
     def run(self):
         while not self.shouldStop.isSet():
             try:
@@ -101,17 +515,17 @@ class upload(threading.Thread):
                     self.current_segno = fdata["segno"]
                     #upload file and finish
                     if self.current_segno == 0:
+                        with self.preview_lock:
+                            self.pending_preview = fdata.get("preview")
                         self.init_capture()
-                    self.upload_one_file(fdata["path"])
+                    if self.connections:
+                        self.dispatch_segment(fdata)
+                    elif fdata.get("streaming"):
+                        self.stream_one_file(fdata["path"])
+                    else:
+                        self.upload_one_file(fdata["path"])
                 elif "end_capture" in fdata:
                     self.end_capture()
-                elif "event" in fdata:
-                    if fdata["event"] == "alarm":
-                        toserver = {
-                            "type": "alarm",
-                            "trigger_timestamp": int(time.time()),
-                        }
-                        self.ctalker.send(json.dumps(toserver))
                 self.inq.task_done()
             except queue.Empty:
                 pass #continue through loop and wait again if necessary
@@ -143,10 +557,12 @@ class upload(threading.Thread):
                 return None
             return (parts[0], ts, segno)
 
-    def add_file(self, fpath):
+    def add_file(self, fpath, streaming=False):
         """
         Add one file to be uploaded to the server.
         This function may be called from any thread
+        streaming: the file is still being written. Its data will be uploaded as it
+        is written, until close_file() is called for it.
         """
         if not os.path.isfile(fpath):
             print("cloudtalker: cannot find file", fpath)
@@ -161,9 +577,43 @@ class upload(threading.Thread):
                 "ts": parsed[1],
                 "segno": parsed[2],
             }
+            if streaming:
+                fdata["streaming"] = True
+                with self.streaming_cond:
+                    self.streaming[fpath] = None
+            elif self.preview_pool and parsed[2] == 0:
+                #start extracting now so the preview is ready by capture_start
+                fdata["preview"] = self.preview_pool.submit(extract_preview, fpath)
             self.inq.put(fdata)
             print("upload module accepted file", fpath)
 
+    def close_file(self, fpath, size=None):
+        """
+        Indicate that a file previously added with streaming=True is complete.
+        size: final size of the file in bytes (read from the file if not given, or
+        if it isn't a valid size)
+        This function may be called from any thread
+        """
+        with self.streaming_cond:
+            if fpath not in self.streaming:
+                print("cloudtalker: close for unknown streaming file", fpath)
+                return None
+        if size is not None:
+            size = toInt(size)
+            if size is None or size < 0:
+                print("cloudtalker: ignoring invalid size for", fpath)
+                size = None
+        if size is None:
+            try:
+                size = os.path.getsize(fpath)
+            except OSError as e:
+                print("cloudtalker: cannot read size of", fpath, e)
+                return None
+        with self.streaming_cond:
+            if fpath in self.streaming:
+                self.streaming[fpath] = size
+                self.streaming_cond.notify_all()
+
     def add_capture_end(self):
         """
         Indicate that no further segment files will be sent for the current capture.
@@ -177,12 +627,14 @@ class upload(threading.Thread):
     def add_event(self, details_dict):
         """
         Add an event, other than a video upload, to be sent to the server.
+        Events are sent straight away, even while a segment is being uploaded.
         Currently, the server only supports "alarm" events.
         """
         fdata = {
             "event": details_dict["event"],
+            "trace": latency.hop(details_dict.get("trace"), "add_event"),
         }
-        self.inq.put(fdata)
+        self.eventq.put(fdata)
 
 class motionUploadManager(threading.Thread):
     """
@@ -262,54 +714,129 @@ class motionUploadManager(threading.Thread):
         """
         self.upload = upload
 
-    def arm(self):
+    def send_command(self, command, trace=None):
+        """
+        Send a command datagram to the listening process, carrying the latency
+        trace (if any) along with it.
+        """
+        if self.cmdsock:
+            msg = {"command": command}
+            #each command gets its own trace, even if several share one server message
+            trace = latency.hop(latency.branch(trace), command)
+            if trace is not None:
+                msg["trace"] = trace
+            self.cmdsock.send(json.dumps(msg).encode())
+
+    def arm(self, trace=None):
         """
         Camera is armed and can receive motion-triggered videos.
         """
         self.isarmed.set()
-        if self.cmdsock:
-            self.cmdsock.send('{"command":"arm"}'.encode())
+        self.send_command("arm", trace)
 
-    def disarm(self):
+    def disarm(self, trace=None):
         """
         Camera is disarmed and should reject all motion-triggered videos.
         """
         self.isarmed.clear()
-        if self.cmdsock:
-            self.cmdsock.send('{"command":"disarm"}'.encode())
+        self.send_command("disarm", trace)
 
-    def capture(self):
+    def capture(self, trace=None):
         """
         User has requested a single video capture regardless of whether there is motion.
         """
-        if self.cmdsock:
-            self.cmdsock.send('{"command":"capture"}'.encode())
+        self.send_command("capture", trace)
+
+    def handle_input(self, js):
+        """
+        Act on one JSON message received on the input socket.
+        Returns True if the message was about a segment file (so the capture
+        will need to be ended when the connection closes).
+        """
+        if not isinstance(js, dict):
+            print("ignoring unexpected input", js)
+            return False
+        if "segment" in js:
+            if self.upload:
+                segment_state = js.get("state")
+                if segment_state == "closed":
+                    self.upload.close_file(js["segment"], js.get("size"))
+                else:
+                    self.upload.add_file(js["segment"],
+                        streaming=(segment_state == "open"))
+                return True
+        elif "event" in js:
+            latency.hop(js.get("trace"), "listensock")
+            if self.upload:
+                self.upload.add_event(js)
+        return False
+
+    def resync(self, buf, decoder):
+        """
+        Find the next well-formed message after a malformed one at the head of buf:
+        a later '{' that follows a '}' (so isn't an object nested inside the first
+        message) and parses. Returns its index, or None if there isn't one (yet).
+        """
+        start = buf.find("{", 1)
+        while start >= 0:
+            if buf[:start].rstrip().endswith("}"):
+                try:
+                    decoder.raw_decode(buf, start)
+                    return start
+                except ValueError:
+                    pass
+            start = buf.find("{", start + 1)
+        return None
 
-    def listensock(self):
+    def listensock(self, max_buffer=65536):
         """
         Listen on an open socket and wait for a connection. Clients can send JSON
         data in the correct format indicating each segment file in a capture.
+        Several messages may arrive back-to-back (or split across reads), so the
+        received data is buffered and parsed one JSON object at a time.
         When the connection is closed, the capture is deemed concluded.
         """
+        decoder = json.JSONDecoder()
         while True:
             capture_end_required = False
             self.insock.listen(1)
             conn, addr = self.insock.accept()
+            utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            buf = ""
             while True:
                 data = conn.recv(1024)
-                if data:
-                    print("socket listener json", data.decode("utf-8"))
-                    #parse and inspect JSON
-                    js = json.loads(data.decode('utf-8'))
-                    if "segment" in js:
-                        if self.upload:
-                            self.upload.add_file(js["segment"])
-                            capture_end_required = True
-                    elif "event" in js:
-                        if self.upload:
-                            self.upload.add_event(js)
-                else:
+                if not data:
                     break
+                buf += utf8.decode(data)
+                print("socket listener json", buf)
+                #parse and inspect each complete JSON message in the buffer
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        js, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        if buf.startswith("{"):
+                            #either incomplete, or malformed. If a well-formed message
+                            #follows it, it was malformed: skip to that message
+                            start = self.resync(buf, decoder)
+                            if start is None:
+                                break #may be incomplete, wait for more data
+                        else:
+                            #junk before the start of the next message
+                            start = buf.find("{")
+                            if start < 0:
+                                start = len(buf)
+                        print("discarding unparseable input", buf[:start][:100])
+                        buf = buf[start:]
+                        continue
+                    buf = buf[end:]
+                    if self.handle_input(js):
+                        capture_end_required = True
+                if len(buf) > max_buffer:
+                    print("discarding unparseable input", buf[:100])
+                    buf = ""
             print("recv data is None, close conn...")
             conn.close()
             if self.upload and capture_end_required:
@@ -424,22 +951,151 @@ class state():
                     serialisedState[k] = v[0]
             return json.dumps(serialisedState, sort_keys=True)
 
+class frameBatch(object):
+    """
+    A group of WebSocket frames that websocket-client's send_frame() writes to the
+    socket as one buffer, so they share a TLS record (and usually a TCP segment).
+    The server still sees ordinary, separate frames.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.get_mask_key = None
+
+    def format(self):
+        for frame in self.frames:
+            if self.get_mask_key:
+                frame.get_mask_key = self.get_mask_key
+        return b"".join(frame.format() for frame in self.frames)
+
+class sendBatcher(threading.Thread):
+    """
+    Coalesces control (text) messages sent within a short window into a single
+    socket write. Messages are always written in the order they were sent.
+    Pending messages are flushed when:
+    - the window since the first pending message expires,
+    - an urgent message is sent,
+    - binary data is sent (so a capture_segment header goes out with its data), or
+    - the pending messages exceed max_bytes or max_messages.
+    While the connection is closed, send() raises (as an unbatched send would), and
+    messages already pending are retried with an increasing delay, up to max_retry.
+    """
+    def __init__(self, ws, window=0.02, max_bytes=16000, max_messages=100, max_retry=30):
+        """
+        ws: websocket-client WebSocketApp to write to
+        window: maximum time (seconds) a control message may wait to be batched
+        max_bytes: flush immediately once this much is pending (one TLS record is 16KB)
+        max_messages: flush immediately once this many messages are pending
+        max_retry: maximum delay (seconds) between flush attempts while disconnected
+        """
+        super(sendBatcher, self).__init__()
+        self.daemon = True
+        self.ws = ws
+        self.window = window
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_retry = max_retry
+        self.retry_delay = window
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+
+    def send(self, data, isText=True, urgent=False):
+        if isText and isinstance(data, str):
+            data = data.encode("utf-8")
+        frame = websocket.ABNF.create_frame(data,
+            websocket.ABNF.OPCODE_TEXT if isText else websocket.ABNF.OPCODE_BINARY)
+        if not self.ws.sock:
+            raise websocket.WebSocketConnectionClosedException(
+                "Connection is already closed.")
+        with self.lock:
+            self.pending.append(frame)
+            self.pending_bytes += len(data)
+            flush_now = (urgent or not isText or self.pending_bytes >= self.max_bytes
+                or len(self.pending) >= self.max_messages)
+            if not flush_now and self.deadline is None:
+                self.deadline = time.monotonic() + self.window
+                self.lock.notify()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all pending messages to the socket now, in one write.
+        """
+        #hold the write lock while taking pending frames, so batches can't be reordered
+        with self.write_lock:
+            with self.lock:
+                if not self.pending:
+                    self.deadline = None
+                    return
+                if not self.ws.sock:
+                    #keep the control messages (binary data can't be resent in order)
+                    #and try again later, backing off while the connection is down
+                    if self.retry_delay == self.window:
+                        print("sendBatcher: connection closed, holding control messages")
+                    self.pending = [frame for frame in self.pending
+                        if frame.opcode == websocket.ABNF.OPCODE_TEXT]
+                    self.pending_bytes = sum(len(frame.data) for frame in self.pending)
+                    self.deadline = time.monotonic() + self.retry_delay if self.pending else None
+                    self.retry_delay = min(self.retry_delay * 2, self.max_retry)
+                    raise websocket.WebSocketConnectionClosedException(
+                        "Connection is already closed.")
+                frames = self.pending
+                self.pending = []
+                self.pending_bytes = 0
+                self.deadline = None
+                self.retry_delay = self.window
+            self.ws.sock.send_frame(frameBatch(frames))
+
+    def run(self):
+        """
+        Flush pending messages when their window expires.
+        """
+        while True:
+            with self.lock:
+                while self.deadline is None:
+                    self.lock.wait()
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(timeout=remaining)
+                    continue
+            try:
+                self.flush()
+            except websocket.WebSocketConnectionClosedException:
+                pass #already reported, and retried with a back-off
+            except Exception as e:
+                print("sendBatcher flush failed:", e)
+
 class cloudtalker():
     """
     Manages WebSocket communication with cloud.
     Links each separate module together: state receiving, state processing, file uploading.
     Regularly heartbeats with server to ensure state is correct and up to date.
     """
-    def __init__(self, upload_mgr=None, state=state()):
+    def __init__(self, upload_mgr=None, state=state(), preview_workers=0, upload_connections=0,
+            batch_window=0):
         """
         Create cloudtalker object.
         upload_mgr: initialise with an upload manager, which will manage the uploading
         of provided capture files to the cloud service (via the internal connection
         created by this class). This will also forward received server messages to
         a listening process if required.
+        preview_workers: number of worker threads extracting capture previews
+        (0 disables previews)
+        upload_connections: number of extra WebSocket connections to stripe capture
+        segments across (0 sends everything on the control connection)
+        batch_window: coalesce control messages sent within this many seconds into
+        one socket write (0 sends every message immediately)
         """
         self.state = state
-        self.upload = upload(ctalker=self)
+        self.batch_window = batch_window
+        self.batcher = None
+        self.url = None
+        self.sslopt = None
+        self.upload = upload(ctalker=self, preview_workers=preview_workers,
+            connections=upload_connections)
         self.motion_upload_mgr = upload_mgr
         if self.motion_upload_mgr:
             self.motion_upload_mgr.set_upload_object(self.upload)
@@ -460,6 +1116,7 @@ class cloudtalker():
 
     def on_message(self, ws, message):
         print(message)
+        trace = latency.start("on_message")
         self.state.process(message)
         self.send(self.state.toJSON(addDict={"type":"state"}))
         #now check for important changes
@@ -467,12 +1124,12 @@ class cloudtalker():
         if self.state.getUpdateTimeWithKey("pir_armed") == updateTime:
             if self.motion_upload_mgr:
                 if self.state["pir_armed"]:
-                    self.motion_upload_mgr.arm()
+                    self.motion_upload_mgr.arm(trace=trace)
                 else:
-                    self.motion_upload_mgr.disarm()
+                    self.motion_upload_mgr.disarm(trace=trace)
         if self.state.getUpdateTimeWithKey("capture_asap") == updateTime:
             if self.motion_upload_mgr:
-                self.motion_upload_mgr.capture()
+                self.motion_upload_mgr.capture(trace=trace)
 
     def on_error(self, ws, error):
         print(error)
@@ -492,15 +1149,20 @@ class cloudtalker():
         if self.upload:
             #start upload thread now
             print("starting upload thread now")
+            self.upload.open_connections(self.url, self.sslopt)
             self.upload.start()
 
-    def send(self, data, isText=True):
+    def send(self, data, isText=True, urgent=False):
         """
         Wrap internal websocket-client data send
+        urgent: don't hold this message back for batching
         """
         if isText:
             print("WebSocket send:", data)
-        self.ws.send(data, opcode=websocket.ABNF.OPCODE_TEXT if isText else websocket.ABNF.OPCODE_BINARY)
+        if self.batcher:
+            self.batcher.send(data, isText=isText, urgent=urgent)
+        else:
+            self.ws.send(data, opcode=websocket.ABNF.OPCODE_TEXT if isText else websocket.ABNF.OPCODE_BINARY)
 
     def sendFile(self, fpath, isMotionTriggered):
         """
@@ -510,16 +1172,20 @@ class cloudtalker():
 
     def connect(self, endpoint, cert, key):
         websocket.enableTrace(True)
-        self.ws = websocket.WebSocketApp("wss://%s" % (endpoint),
+        self.url = "wss://%s" % (endpoint)
+        self.sslopt = {"cert_reqs": ssl.CERT_NONE,
+            "ssl_version": ssl.PROTOCOL_TLSv1_2,
+            "keyfile": key,
+            "certfile": cert}
+        self.ws = websocket.WebSocketApp(self.url,
             on_message = self.on_message,
             on_error = self.on_error,
             on_close = self.on_close,
             on_open = self.on_open)
-        self.ws.run_forever(ping_interval=55,
-            sslopt={"cert_reqs": ssl.CERT_NONE,
-                "ssl_version": ssl.PROTOCOL_TLSv1_2,
-                "keyfile": key,
-                "certfile": cert})
+        if self.batch_window:
+            self.batcher = sendBatcher(self.ws, window=self.batch_window)
+            self.batcher.start()
+        self.ws.run_forever(ping_interval=55, sslopt=self.sslopt)
 
 
 if __name__ == "__main__":
@@ -543,18 +1209,32 @@ if __name__ == "__main__":
             "(i.e. arm|disarm|capture, etc., overwrites cam_addr)")
         parser.add_argument('--cam_addr', default=None,
             help="INet dgram ip:port address to send commands to (i.e. arm|disarm|capture, etc.)")
+        parser.add_argument('--preview_workers', default=0, type=int,
+            help="Send a keyframe preview of each capture ahead of the video data, "
+            "extracting it with ffmpeg in this many worker threads (0 disables previews)")
+        parser.add_argument('--upload_connections', default=0, type=int,
+            help="Open this many extra WebSocket connections and upload capture "
+            "segments across them in parallel (0 uploads on the control connection only)")
+        parser.add_argument('--batch_window', default=0, type=float,
+            help="Coalesce control messages sent within this many seconds into one "
+            "socket write (0 sends each message immediately)")
+        parser.add_argument('--trace_log', default=None,
+            help="Append per-hop latency trace records to this file (tracing is off if unset)")
         return parser.parse_args()
 
     print("app started now")
     #initialise serial ports and hardware
     args = get_args()
+    latency.open(args.trace_log)
     print(os.path.dirname(os.path.realpath(__file__)))
     print(os.getcwd())
 
     with motionUploadManager(motion_file_list=args.motion_file_list,
             insock=args.input_sock, cmdsock=args.cam_sock,
             inport=args.input_port, cmdaddr=args.cam_addr) as mgr:
-        with cloudtalker(upload_mgr=mgr) as ctalker:
+        with cloudtalker(upload_mgr=mgr, preview_workers=args.preview_workers,
+                upload_connections=args.upload_connections,
+                batch_window=args.batch_window) as ctalker:
             ctalker.connect(args.endpoint, args.cert, args.key)
             print("cloudConnect exited")
 
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+
+def percentile(values, pct):
+    """
+    Return the nearest-rank percentile of an already-sorted list of values
+    """
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def read_logs(paths):
+    """
+    Read and merge the trace records from each JSON-lines trace log.
+    Returns a dict of <trace id>:[records sorted by monotonic timestamp]
+    """
+    traces = {}
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print("skipping bad trace record in", path, file=sys.stderr)
+                    continue
+                traces.setdefault(record["id"], []).append(record)
+    for records in traces.values():
+        records.sort(key=lambda r: r["t"])
+    return traces
+
+def collect_latencies(traces):
+    """
+    Group latencies by hop (from->to) and by full path (first hop to last hop).
+    Returns a tuple of dicts (hops, paths), each of <name>:[latency in seconds]
+    """
+    hops = {}
+    paths = {}
+    for records in traces.values():
+        for r in records:
+            name = "%s -> %s" % (r["from"], r["to"])
+            hops.setdefault(name, []).append(r["dt"])
+        name = " -> ".join([records[0]["from"]] + [r["to"] for r in records])
+        paths.setdefault(name, []).append(sum(r["dt"] for r in records))
+    return (hops, paths)
+
+def print_table(title, latencies):
+    width = max([len(name) for name in latencies] + [0])
+    print(title)
+    print("  %-*s %6s %9s %9s %9s %9s" % (width, "", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        print("  %-*s %6d %9.3f %9.3f %9.3f %9.3f" % (width, name, len(values),
+            percentile(values, 50) * 1000, percentile(values, 90) * 1000,
+            percentile(values, 99) * 1000, values[-1] * 1000))
+
+if __name__ == "__main__":
+    def get_args():
+        import argparse
+        parser = argparse.ArgumentParser(description="Merge cloudtalker and actuator"
+            " trace logs (written with --trace_log) and print per-hop latency percentiles")
+        parser.add_argument('logs', nargs='+', help="Trace log files to merge")
+        return parser.parse_args()
+
+    args = get_args()
+    hops, paths = collect_latencies(read_logs(args.logs))
+    print_table("Per-hop latency:", hops)
+    print_table("End-to-end latency:", paths)
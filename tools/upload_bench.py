@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark single-connection vs. multi-connection capture uploads.
+
+Runs a local stand-in for the cloud service (a minimal, plain ws:// WebSocket
+server that only counts what it receives) behind a user-space proxy that delays
+traffic and limits each TCP connection to a fixed in-flight window, emulating a
+high-latency cellular link. A capture is then uploaded with cloudtalker's upload
+class, once for each requested number of extra upload connections.
+"""
+
+import base64
+import collections
+import hashlib
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    "..", "src", "cloudtalker"))
+import websocket
+import cloudtalker
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def recv_exact(conn, n):
+    data = b""
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+class standInServer(threading.Thread):
+    """
+    Accepts WebSocket connections and counts binary bytes received, noting when
+    a capture_end message arrives on any connection.
+    """
+    def __init__(self, port):
+        super(standInServer, self).__init__()
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(16)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.binary_bytes = 0
+            self.capture_ended = False
+
+    def wait_for(self, nbytes, timeout=300):
+        """
+        Wait until nbytes of segment data and a capture_end have been received.
+        Returns the time at which that happened.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.binary_bytes < nbytes or not self.capture_ended:
+                if not self.changed.wait(timeout=deadline - time.monotonic()):
+                    raise RuntimeError("timed out waiting for upload")
+        return time.monotonic()
+
+    def handle(self, conn):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        key = None
+        for line in request.decode("latin-1").split("\r\n"):
+            if line.lower().startswith("sec-websocket-key:"):
+                key = line.split(":", 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        conn.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+            "Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+        try:
+            while True:
+                b0, b1 = recv_exact(conn, 2)
+                opcode = b0 & 0x0f
+                length = b1 & 0x7f
+                if length == 126:
+                    length = struct.unpack("!H", recv_exact(conn, 2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", recv_exact(conn, 8))[0]
+                mask = recv_exact(conn, 4) if b1 & 0x80 else None
+                payload = recv_exact(conn, length)
+                if opcode == 0x8: #close
+                    break
+                with self.changed:
+                    if opcode == 0x2:
+                        self.binary_bytes += length
+                    elif opcode == 0x1 and mask:
+                        text = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                        if b'"capture_end"' in text:
+                            self.capture_ended = True
+                    self.changed.notify_all()
+        except (EOFError, OSError):
+            pass
+        conn.close()
+
+    def run(self):
+        while True:
+            conn, addr = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+class delayProxy(threading.Thread):
+    """
+    TCP proxy adding a one-way delay in each direction, and allowing at most
+    'window' bytes in flight per connection until they are 'acknowledged' one
+    round trip after being read. This caps each connection at window/RTT.
+    """
+    def __init__(self, port, target, delay, window):
+        super(delayProxy, self).__init__()
+        self.daemon = True
+        self.target = target
+        self.delay = delay
+        self.window = window
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(16)
+
+    def pipe(self, src, dst):
+        pending = collections.deque()
+        releases = collections.deque()
+        cond = threading.Condition()
+        state = {"inflight": 0, "eof": False}
+
+        def writer():
+            while True:
+                with cond:
+                    while not pending and not state["eof"]:
+                        cond.wait()
+                    if not pending:
+                        break
+                    due, data = pending.popleft()
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    break
+                with cond:
+                    releases.append((time.monotonic() + self.delay, len(data)))
+                    cond.notify_all()
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        threading.Thread(target=writer, daemon=True).start()
+        while True:
+            with cond:
+                while True:
+                    now = time.monotonic()
+                    while releases and releases[0][0] <= now:
+                        state["inflight"] -= releases.popleft()[1]
+                    if state["inflight"] < self.window:
+                        break
+                    cond.wait(timeout=releases[0][0] - now if releases else None)
+                room = self.window - state["inflight"]
+            try:
+                data = src.recv(min(room, 65536))
+            except OSError:
+                data = b""
+            with cond:
+                if not data:
+                    state["eof"] = True
+                    cond.notify_all()
+                    break
+                state["inflight"] += len(data)
+                pending.append((time.monotonic() + self.delay, data))
+                cond.notify_all()
+
+    def run(self):
+        while True:
+            client, addr = self.sock.accept()
+            server = socket.create_connection(self.target)
+            threading.Thread(target=self.pipe, args=(client, server), daemon=True).start()
+            threading.Thread(target=self.pipe, args=(server, client), daemon=True).start()
+
+class benchTalker(object):
+    """
+    Stands in for the cloudtalker object: just the control connection's send().
+    """
+    def __init__(self, url):
+        self.ws = websocket.create_connection(url)
+
+    def send(self, data, isText=True, urgent=False):
+        self.ws.send(data, opcode=websocket.ABNF.OPCODE_TEXT if isText else websocket.ABNF.OPCODE_BINARY)
+
+def run_upload(url, server, files, connections):
+    server.reset()
+    ctalker = benchTalker(url)
+    up = cloudtalker.upload(ctalker, connections=connections)
+    up.open_connections(url)
+    up.start()
+    start = time.monotonic()
+    for fpath in files:
+        up.add_file(fpath)
+    up.add_capture_end()
+    end = server.wait_for(sum(os.path.getsize(f) for f in files))
+    up.join()
+    ctalker.ws.close()
+    return end - start
+
+if __name__ == "__main__":
+    def get_args():
+        import argparse
+        parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument('--rtt', default=0.1, type=float,
+            help="Emulated round-trip time (seconds)")
+        parser.add_argument('--window', default=65536, type=int,
+            help="Emulated per-connection in-flight window (bytes)")
+        parser.add_argument('--segments', default=4, type=int,
+            help="Number of segment files in the capture")
+        parser.add_argument('--segment_size', default=1000000, type=int,
+            help="Size of each segment file (bytes)")
+        parser.add_argument('--connections', default="0,2,4",
+            help="Comma-separated numbers of extra upload connections to try")
+        parser.add_argument('--port', default=9500, type=int,
+            help="Port for the stand-in server (the proxy uses port + 1)")
+        return parser.parse_args()
+
+    args = get_args()
+    server = standInServer(args.port)
+    server.start()
+    proxy = delayProxy(args.port + 1, ("127.0.0.1", args.port), args.rtt / 2, args.window)
+    proxy.start()
+    url = "ws://127.0.0.1:%d/" % (args.port + 1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = []
+        for segno in range(args.segments):
+            fpath = os.path.join(tmpdir, "pir.1529842538.%d.mp4" % segno)
+            with open(fpath, "wb") as f:
+                f.write(os.urandom(args.segment_size))
+            files.append(fpath)
+        total = args.segments * args.segment_size
+        results = []
+        for n in [int(n) for n in args.connections.split(",")]:
+            elapsed = run_upload(url, server, files, n)
+            results.append((n, elapsed))
+        print("rtt %.0f ms, window %d bytes, %d x %d byte segments" % (args.rtt * 1000,
+            args.window, args.segments, args.segment_size))
+        for n, elapsed in results:
+            print("  %d extra connections: %7.2f s  %8.1f KiB/s" % (n, elapsed,
+                total / elapsed / 1024))